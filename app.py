@@ -1,148 +1,285 @@
 import os
-import json
+import orjson
 import time
+import asyncio
+import hashlib
+import functools
+import threading
+import logging
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
 import gradio as gr
 import google.generativeai as genai
 from dotenv import load_dotenv
-import pandas as pd
-import matplotlib.pyplot as plt
+import faiss
+from sentence_transformers import SentenceTransformer
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # --- Configuration ---
 DEFAULT_KEY = "Enter Your GEMINI API KEY HERE"
 API_KEY = os.getenv("GEMINI_API_KEY", DEFAULT_KEY)
 
 if API_KEY:
-    genai.configure(api_key=API_KEY)
+    # gRPC is already the SDK default; pinned so the shared HTTP/2 channel
+    # that all model objects multiplex over is an explicit choice
+    genai.configure(api_key=API_KEY, transport="grpc")
 
 # --- Prompt Templates ---
-MOOD_DETECTION_PROMPT = """
-You are an expert psychological mood analyzer. Analyze the following user input (text and/or audio transcript) and determine the user's current mood.
-Classify the mood into one of these labels: Happy, Sad, Anxious, Angry, Neutral, Overwhelmed, Depressive, Suicidal-Risk.
-Also provide a confidence score (0-100).
-Input: "{input_text}"
-Output format (JSON):
-{{
-  "mood": "Label",
-  "confidence": 85,
-  "risk_flag": boolean
-}}
+# Shared persona, sent once per call as the model's system instruction
+# instead of being repeated inside every prompt
+SYSTEM_PERSONA = """
+You are EmotiCare, an expert psychological mood analyzer and a compassionate, empathetic therapy coach.
+You are warm, supportive and non-judgmental. You never diagnose.
 """
 
-THERAPY_RESPONSE_PROMPT = """
-You are a compassionate, empathetic therapy coach named EmotiCare. The user is feeling "{mood}".
-Generate a supportive, non-judgmental response. Acknowledge their feelings, validate them, and offer a comforting perspective.
-Keep it warm and conversational. Do not diagnose.
+ANALYSIS_PROMPT = """
+Analyze the following user input (text and/or audio transcript) and complete every task below.
+1. mood: Classify the mood into one of these labels: Happy, Sad, Anxious, Angry, Neutral, Overwhelmed, Depressive, Suicidal-Risk.
+   Also provide a confidence score (0-100) and a risk_flag.
+2. crisis: Check strictly for self-harm, suicide, or immediate danger.
+   If ANY risk is detected, set is_crisis to true and give a short reason.
+3. summary: Summarize the user's situation in 7-10 words.
+4. actions: Provide 3 short, actionable coping mechanisms:
+   breathing = Breathing/grounding (Immediate), immediate = Small step (Now), long_term = Long-term action.
+5. themes: Extract 3 key themes or emotions for journaling.
+6. prompts: Suggest 2 specific journaling prompts.
 User Input: "{input_text}"
 """
 
-JOURNALING_ANALYSIS_PROMPT = """
-Analyze the user's entry for journaling purposes.
-Extract 3 key themes or emotions.
-Suggest 2 specific journaling prompts.
+THERAPY_RESPONSE_PROMPT = """
+The user is feeling "{mood}". Generate a supportive response.
+Acknowledge their feelings, validate them, and offer a comforting perspective. Keep it conversational.
 User Input: "{input_text}"
-Mood: "{mood}"
-Output format (JSON):
-{{
-  "themes": ["theme1", "theme2", "theme3"],
-  "prompts": ["prompt1", "prompt2"]
-}}
 """
 
 CRISIS_CHECK_PROMPT = """
 Analyze the following input strictly for self-harm, suicide, or immediate danger.
-If ANY risk is detected, output TRUE and a short reason. Otherwise output FALSE.
-Input: "{input_text}"
-Output format (JSON):
-{{
-  "is_crisis": boolean,
-  "reason": "explanation"
-}}
-"""
-
-SUMMARY_PROMPT = """
-Summarize the user's situation in 7-10 words.
-Then provide 3 short, actionable coping mechanisms:
-1. Breathing/grounding (Immediate).
-2. Small step (Now).
-3. Long-term action.
+If ANY risk is detected, set is_crisis to true and give a short reason.
 User Input: "{input_text}"
-Mood: "{mood}"
-Output format (JSON):
-{{
-  "summary": "short summary",
-  "actions": {{
-    "breathing": "description",
-    "immediate": "description",
-    "long_term": "description"
-  }}
-}}
 """
 
+CRISIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "is_crisis": {"type": "BOOLEAN"},
+        "reason": {"type": "STRING"}
+    },
+    "required": ["is_crisis", "reason"]
+}
+
+ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "mood": {"type": "STRING"},
+        "confidence": {"type": "INTEGER"},
+        "risk_flag": {"type": "BOOLEAN"},
+        "crisis": CRISIS_SCHEMA,
+        "summary": {"type": "STRING"},
+        "actions": {
+            "type": "OBJECT",
+            "properties": {
+                "breathing": {"type": "STRING"},
+                "immediate": {"type": "STRING"},
+                "long_term": {"type": "STRING"}
+            },
+            "required": ["breathing", "immediate", "long_term"]
+        },
+        "themes": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "prompts": {"type": "ARRAY", "items": {"type": "STRING"}}
+    },
+    "required": ["mood", "confidence", "risk_flag", "crisis", "summary", "actions", "themes", "prompts"]
+}
+
+ANALYSIS_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": ANALYSIS_SCHEMA
+}
+
+CRISIS_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": CRISIS_SCHEMA
+}
+
 # --- Helper Functions ---
-HISTORY_FILE = "journal_history.json"
+HISTORY_FILE = "journal_history.jsonl"
+HISTORY_LIMIT = 20
+LEGACY_HISTORY_FILE = "journal_history.json"
 
-def load_history():
-    if os.path.exists(HISTORY_FILE):
+# In-memory copy of the latest entries; disk is only touched on writes
+history_cache = None
+history_lock = threading.Lock()
+
+# Background writer for history and exports. A single worker keeps
+# history appends in submission order.
+disk_executor = ThreadPoolExecutor(max_workers=1)
+
+def log_write_error(future):
+    # Background writes have no caller waiting on them, so failures are logged here
+    error = future.exception()
+    if error is not None:
+        logger.error("Background write failed: %s", error)
+
+def import_legacy_history():
+    """
+    One-time import of the old journal_history.json (a newest-first list)
+    into the JSONL log (oldest first). Skipped once the JSONL file exists.
+    """
+    if os.path.exists(HISTORY_FILE) or not os.path.exists(LEGACY_HISTORY_FILE):
+        return
+    try:
+        with open(LEGACY_HISTORY_FILE, "rb") as f:
+            entries = orjson.loads(f.read())
+        with open(HISTORY_FILE, "wb") as f:
+            f.write(b"".join(orjson.dumps(entry) + b"\n" for entry in reversed(entries)))
+    except Exception as e:
+        logger.error("Could not import %s: %s", LEGACY_HISTORY_FILE, e)
+
+def read_tail(path, count, block_size=4096):
+    """
+    Returns the raw bytes holding at least the last `count` lines of a file,
+    reading backwards from the end so cost does not grow with the file.
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        while pos > 0 and data.count(b"\n") <= count:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    return data
+
+def read_history_file():
+    """
+    Returns the latest HISTORY_LIMIT entries, newest first.
+    Only the tail of the append-only log is read; unreadable lines are skipped.
+    """
+    import_legacy_history()
+    if not os.path.exists(HISTORY_FILE):
+        return []
+    try:
+        data = read_tail(HISTORY_FILE, HISTORY_LIMIT)
+    except OSError as e:
+        logger.error("Could not read %s: %s", HISTORY_FILE, e)
+        return []
+
+    # A crash mid-append leaves a torn last line; terminate it so the next
+    # append starts on a fresh line instead of being glued onto it
+    if data and not data.endswith(b"\n"):
+        with open(HISTORY_FILE, "ab") as f:
+            f.write(b"\n")
+
+    history = []
+    for line in reversed(data.splitlines()[-HISTORY_LIMIT:]):
+        if not line.strip():
+            continue
         try:
-            with open(HISTORY_FILE, "r") as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+            history.append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            continue
+    return history
+
+def append_history_file(entry):
+    with history_lock:
+        with open(HISTORY_FILE, "ab") as f:
+            f.write(orjson.dumps(entry) + b"\n")
+
+def load_history():
+    global history_cache
+    if history_cache is None:
+        history_cache = read_history_file()
+    return history_cache
 
 def save_history(entry):
+    # Load first so the log is read (and any legacy file imported) before this append
     history = load_history()
+    # Persist a copy so the in-memory "_html" card below never reaches disk
+    disk_executor.submit(append_history_file, dict(entry)).add_done_callback(log_write_error)
+    entry["_html"] = format_history_card(entry)
     history.insert(0, entry)
-    history = history[:20]
-    with open(HISTORY_FILE, "w") as f:
-        json.dump(history, f, indent=2)
+    del history[HISTORY_LIMIT:]
     return history
 
-def format_history_html(history):
-    if not history:
-        return "<p style='color: #9ca3af; text-align: center; margin-top: 20px;'>No entries yet. Start journaling!</p>"
-    
-    html = "<div class='history-container'>"
-    for item in history:
-        mood = item.get('mood', 'Neutral')
-        color_map = {
-            'Happy': '#10b981', 'Neutral': '#6b7280', 
-            'Sad': '#3b82f6', 'Depressive': '#1d4ed8',
-            'Anxious': '#f59e0b', 'Overwhelmed': '#d97706',
-            'Angry': '#ef4444', 'Suicidal-Risk': '#b91c1c'
-        }
-        color = color_map.get(mood, '#6b7280')
-        
-        html += f"""
+MOOD_COLORS = {
+    'Happy': '#10b981', 'Neutral': '#6b7280', 
+    'Sad': '#3b82f6', 'Depressive': '#1d4ed8',
+    'Anxious': '#f59e0b', 'Overwhelmed': '#d97706',
+    'Angry': '#ef4444', 'Suicidal-Risk': '#b91c1c'
+}
+
+HISTORY_CARD_TEMPLATE = """
         <div class='history-card' style='border-left: 4px solid {color};'>
             <div style='display: flex; justify-content: space-between; margin-bottom: 5px;'>
                 <span style='font-weight: bold; color: {color};'>{mood}</span>
-                <span style='font-size: 0.8em; color: #9ca3af;'>{item['timestamp']}</span>
+                <span style='font-size: 0.8em; color: #9ca3af;'>{timestamp}</span>
             </div>
-            <p style='font-size: 0.9em; color: #4b5563; margin: 0;'>{item['summary']}</p>
+            <p style='font-size: 0.9em; color: #4b5563; margin: 0;'>{summary}</p>
         </div>
         """
-    html += "</div>"
-    return html
+
+def format_history_card(item):
+    mood = item.get('mood', 'Neutral')
+    return HISTORY_CARD_TEMPLATE.format(
+        color=MOOD_COLORS.get(mood, '#6b7280'),
+        mood=mood,
+        timestamp=item['timestamp'],
+        summary=item['summary']
+    )
+
+def format_history_html(history):
+    if not history:
+        return "<p style='color: #9ca3af; text-align: center; margin-top: 20px;'>No entries yet. Start journaling!</p>"
+    
+    # Cards are rendered once per entry; entries loaded from disk are filled in here
+    for item in history:
+        if "_html" not in item:
+            item["_html"] = format_history_card(item)
+    return "<div class='history-container'>" + "".join(item["_html"] for item in history) + "</div>"
+
+@functools.lru_cache(maxsize=1)
+def get_matplotlib():
+    """
+    Imports matplotlib on first plot, so processes that never draw
+    the mood trend skip its import cost.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    return Figure, FigureCanvasAgg
+
+# Holds only the figure for the latest mood sequence
+mood_plot_cache = {}
 
 def plot_mood_trend(history):
     if not history:
         return None
-    df = pd.DataFrame(history)
-    if 'mood' not in df.columns:
+    moods = [h['mood'] for h in history if 'mood' in h]
+    if not moods:
         return None
-    mood_counts = df['mood'].value_counts()
+
+    key = hash(tuple(moods))
+    cached_fig = mood_plot_cache.get(key)
+    if cached_fig is not None:
+        return cached_fig
+
+    mood_counts = Counter(moods).most_common()
     
-    fig, ax = plt.subplots(figsize=(6, 3.5))
+    # Figure + Agg canvas directly, bypassing pyplot's global figure registry
+    Figure, FigureCanvasAgg = get_matplotlib()
+    fig = Figure(figsize=(6, 3.5))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
     fig.patch.set_facecolor('#f9fafb')
     ax.set_facecolor('#f9fafb')
     
-    colors = ['#2dd4bf' for _ in range(len(mood_counts))]
-    mood_counts.plot(kind='bar', ax=ax, color=colors, edgecolor='white', linewidth=0.5)
+    ax.bar([m for m, _ in mood_counts], [c for _, c in mood_counts], color='#2dd4bf', edgecolor='white', linewidth=0.5)
     
     ax.set_title("Mood Trends", fontsize=10, fontweight='bold', color='#374151')
     ax.set_xlabel("", fontsize=8)
@@ -151,29 +288,50 @@ def plot_mood_trend(history):
     ax.tick_params(axis='y', labelsize=8, colors='#4b5563')
     ax.spines['top'].set_visible(False)
     ax.spines['right'].set_visible(False)
-    plt.tight_layout()
+    fig.tight_layout()
+
+    # Replace rather than clear the old figure: another request may still be
+    # rendering it, and it is not in pyplot's registry so nothing leaks
+    mood_plot_cache.clear()
+    mood_plot_cache[key] = fig
     return fig
 
 # --- ROBUST MODEL GENERATION ---
-def generate_with_fallback(prompt):
+# Priority list: 2.5 Flash (Fastest) -> 2.5 Pro (Best) -> Pro (Legacy/Stable)
+CANDIDATE_MODELS = [
+    'gemini-2.5-flash',
+    'gemini-2.5-pro',
+    'gemini-pro',
+    'gemini-2.0-pro'
+]
+
+# Model objects are built once and reused for every request
+MODELS = [genai.GenerativeModel(model_name, system_instruction=SYSTEM_PERSONA) for model_name in CANDIDATE_MODELS]
+
+# Index of the last model that answered; tried first on the next call.
+# After MODEL_RESET_INTERVAL seconds the faster models get another chance.
+MODEL_RESET_INTERVAL = 600  # seconds
+last_good_idx = 0
+last_good_time = 0.0
+
+def generate_with_fallback(prompt, generation_config=None, stream=False):
     """
     Attempts to generate content using a list of models in priority order.
     If one fails (e.g. 404 Not Found), it tries the next.
     """
-    # Priority list: 1.5 Flash (Fastest) -> 1.5 Pro (Best) -> Pro (Legacy/Stable)
-    candidate_models = [
-        'gemini-2.5-flash',
-        'gemini-2.5-pro',
-        'gemini-pro',
-        'gemini-2.0-pro'
-    ]
-    
+    global last_good_idx, last_good_time
+    if last_good_idx and time.time() - last_good_time > MODEL_RESET_INTERVAL:
+        last_good_idx = 0
+
+    order = [last_good_idx] + [i for i in range(len(MODELS)) if i != last_good_idx]
     last_error = None
     
-    for model_name in candidate_models:
+    for idx in order:
         try:
-            model = genai.GenerativeModel(model_name)
-            response = model.generate_content(prompt)
+            response = MODELS[idx].generate_content(prompt, generation_config=generation_config, stream=stream)
+            if idx != last_good_idx:
+                last_good_idx = idx
+                last_good_time = time.time()
             return response
         except Exception as e:
             last_error = e
@@ -183,103 +341,292 @@ def generate_with_fallback(prompt):
     # If all failed, raise the last error
     raise last_error
 
-def analyze_process(text_input, audio_input):
+# Caps in-flight Gemini requests to stay within API rate limits
+GEMINI_SEMAPHORE = asyncio.Semaphore(5)
+
+async def generate_async(prompt, generation_config=None):
+    """
+    Runs generate_with_fallback in the default thread pool so that
+    Gemini calls do not block the event loop.
+    """
+    async with GEMINI_SEMAPHORE:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, generate_with_fallback, prompt, generation_config)
+
+async def stream_async(prompt):
+    """
+    Streams a Gemini response, yielding text chunks as they arrive.
+    Each chunk is pulled in the default thread pool to keep the event loop free.
+    """
+    async with GEMINI_SEMAPHORE:
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, functools.partial(generate_with_fallback, prompt, stream=True))
+        chunks = iter(response)
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk.parts:
+                yield chunk.text
+
+# --- Exact-Match Response Cache ---
+EXACT_CACHE_TTL = 3600  # seconds
+EXACT_CACHE_SIZE = 256
+
+exact_cache = OrderedDict()
+
+def exact_key(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def exact_lookup(key):
+    hit = exact_cache.get(key)
+    if hit is None:
+        return None
+    ts, result = hit
+    if time.time() - ts >= EXACT_CACHE_TTL:
+        del exact_cache[key]
+        return None
+    exact_cache.move_to_end(key)
+    return result
+
+def exact_save(key, result):
+    exact_cache[key] = (time.time(), result)
+    exact_cache.move_to_end(key)
+    # Evict least recently used entries
+    while len(exact_cache) > EXACT_CACHE_SIZE:
+        exact_cache.popitem(last=False)
+
+# --- Semantic Response Cache ---
+SEMANTIC_INDEX_FILE = "semantic_cache.index"
+SEMANTIC_STORE_FILE = "semantic_cache.json"
+SIMILARITY_THRESHOLD = 0.92
+SEMANTIC_CACHE_SIZE = 1000
+
+embedder = SentenceTransformer('all-MiniLM-L6-v2')
+
+def load_semantic_cache():
+    """
+    Loads the FAISS index and its parallel list of cached results from disk.
+    Starts empty if either file is missing or they are out of sync.
+    """
+    if os.path.exists(SEMANTIC_INDEX_FILE) and os.path.exists(SEMANTIC_STORE_FILE):
+        try:
+            index = faiss.read_index(SEMANTIC_INDEX_FILE)
+            with open(SEMANTIC_STORE_FILE, "rb") as f:
+                store = orjson.loads(f.read())
+            if index.ntotal == len(store):
+                return index, store
+        except:
+            pass
+    return faiss.IndexFlatIP(embedder.get_sentence_embedding_dimension()), []
+
+semantic_index, semantic_store = load_semantic_cache()
+# Lookups and saves both run in worker threads; the lock keeps the index
+# and its parallel result list consistent between them
+semantic_lock = threading.Lock()
+
+def embed_text(text):
+    emb = embedder.encode([text], convert_to_numpy=True).astype('float32')
+    faiss.normalize_L2(emb)
+    return emb
+
+def semantic_lookup(emb):
+    with semantic_lock:
+        if semantic_index.ntotal == 0:
+            return None
+        scores, ids = semantic_index.search(emb, 1)
+        # Vectors are L2-normalized, so inner product is cosine similarity
+        if scores[0][0] > SIMILARITY_THRESHOLD:
+            return semantic_store[ids[0][0]]
+    return None
+
+def write_semantic_files(index_bytes, store_bytes):
+    with open(SEMANTIC_INDEX_FILE, "wb") as f:
+        f.write(index_bytes)
+    with open(SEMANTIC_STORE_FILE, "wb") as f:
+        f.write(store_bytes)
+
+def semantic_save(emb, result):
+    """
+    Adds a result to the cache and queues a write of the new snapshot.
+    Called from a worker thread; serializing up to SEMANTIC_CACHE_SIZE
+    entries is too slow for the event loop.
+    """
+    with semantic_lock:
+        semantic_index.add(emb)
+        semantic_store.append(result)
+
+        # Evict the oldest entries; a flat index keeps insertion order when ids are removed
+        overflow = len(semantic_store) - SEMANTIC_CACHE_SIZE
+        if overflow > 0:
+            semantic_index.remove_ids(faiss.IDSelectorRange(0, overflow))
+            del semantic_store[:overflow]
+
+        # Snapshot under the lock so the background write never sees a half-updated cache
+        index_bytes = faiss.serialize_index(semantic_index).tobytes()
+        store_bytes = orjson.dumps(semantic_store)
+    disk_executor.submit(write_semantic_files, index_bytes, store_bytes).add_done_callback(log_write_error)
+
+def render_result(final_input, result):
+    """
+    Saves the analysis to history and builds the UI outputs for it.
+    """
+    entry = {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M"),
+        "input": final_input[:50] + "...",
+        "mood": result["mood"],
+        "confidence": result["confidence"],
+        "summary": result["summary"]
+    }
+    history = save_history(entry)
+
+    return (
+        f"{result['mood']} ({result['confidence']}%)", 
+        result["therapy"], 
+        result["actions_html"], 
+        result["journal_html"], 
+        plot_mood_trend(history), 
+        format_history_html(history),
+        gr.update(visible=False)
+    )
+
+def crisis_outputs():
+    risk_msg = f"""
+    <div class='risk-alert'>
+        <h3>⚠️ CRITICAL SAFETY WARNING</h3>
+        <p>We detected content indicating high distress. Please prioritize your safety.</p>
+        <p><strong>Immediate Help:</strong></p>
+        <ul>
+            <li>🇺🇸 USA: 988</li>
+            <li>🇮🇳 India: 9152987821</li>
+            <li>Global: <a href='https://findahelpline.com' target='_blank'>findahelpline.com</a></li>
+        </ul>
+    </div>
+    """
+    return "Crisis Detected", "Please seek help.", "See safety card.", "High Risk", None, format_history_html(load_history()), gr.update(value=risk_msg, visible=True)
+
+async def analyze_process(text_input, audio_input):
     if not API_KEY:
-        return "⚠️ API Key Error.", "", "", "", None, "", gr.update(visible=False)
+        yield "⚠️ API Key Error.", "", "", "", None, "", gr.update(visible=False)
+        return
     if not text_input and not audio_input:
-        return "Please share your thoughts first.", "", "", "", None, "", gr.update(visible=False)
+        yield "Please share your thoughts first.", "", "", "", None, "", gr.update(visible=False)
+        return
 
     final_input = text_input
+    # Gradio runs async handlers on the server event loop, so disk, plotting and
+    # embedding work is pushed to the default thread pool to keep other sessions responsive
+    loop = asyncio.get_running_loop()
 
     try:
-        # 1. Mood Detection
-        mood_res = generate_with_fallback(MOOD_DETECTION_PROMPT.format(input_text=final_input))
-        mood_data = json.loads(mood_res.text.replace('```json', '').replace('```', ''))
-        mood = mood_data.get("mood", "Unknown")
-        confidence = mood_data.get("confidence", 0)
-        is_risk = mood_data.get("risk_flag", False)
-
-        # 2. Crisis Check
-        if is_risk:
-            crisis_result = {"is_crisis": True}
-        else:
-            crisis_res = generate_with_fallback(CRISIS_CHECK_PROMPT.format(input_text=final_input))
-            crisis_result = json.loads(crisis_res.text.replace('```json', '').replace('```', ''))
-
-        # Safety Intervention
-        if crisis_result.get("is_crisis"):
-            risk_msg = f"""
-            <div class='risk-alert'>
-                <h3>⚠️ CRITICAL SAFETY WARNING</h3>
-                <p>We detected content indicating high distress. Please prioritize your safety.</p>
-                <p><strong>Immediate Help:</strong></p>
-                <ul>
-                    <li>🇺🇸 USA: 988</li>
-                    <li>🇮🇳 India: 9152987821</li>
-                    <li>Global: <a href='https://findahelpline.com' target='_blank'>findahelpline.com</a></li>
-                </ul>
-            </div>
-            """
-            return "Crisis Detected", "Please seek help.", "See safety card.", "High Risk", None, format_history_html(load_history()), gr.update(value=risk_msg, visible=True)
-
-        # 3. Therapy Response
-        therapy_msg = generate_with_fallback(THERAPY_RESPONSE_PROMPT.format(input_text=final_input, mood=mood)).text
+        # 0. Response Caches - exact repeats first, then near-duplicate inputs
+        key = exact_key(final_input)
+        cached = exact_lookup(key)
+        semantic_hit = False
+        if cached is None:
+            emb = await loop.run_in_executor(None, embed_text, final_input)
+            cached = await loop.run_in_executor(None, semantic_lookup, emb)
+            semantic_hit = cached is not None
+
+        if semantic_hit:
+            # A semantic hit belongs to a different (similar) input, so the new
+            # text gets its own crisis check before the analysis is reused.
+            # Exact hits skip this: the identical text already passed the check,
+            # and crisis results are never cached.
+            crisis_prompt = CRISIS_CHECK_PROMPT.format(input_text=final_input)
+            crisis_res = await generate_async(crisis_prompt, CRISIS_CONFIG)
+            if orjson.loads(crisis_res.text).get("is_crisis"):
+                yield await loop.run_in_executor(None, crisis_outputs)
+                return
+            exact_save(key, cached)
+
+        if cached:
+            yield await loop.run_in_executor(None, render_result, final_input, cached)
+            return
+
+        # 1. Analysis - mood, crisis check, summary & journaling in one call
+        # Prompts are formatted once here; fallback retries reuse the same string
+        analysis_prompt = ANALYSIS_PROMPT.format(input_text=final_input)
+        analysis_res = await generate_async(analysis_prompt, ANALYSIS_CONFIG)
+        analysis = orjson.loads(analysis_res.text)
+        mood = analysis.get("mood", "Unknown")
+        confidence = analysis.get("confidence", 0)
+        crisis_result = analysis.get("crisis", {})
+
+        # Safety Intervention (crisis results are never cached)
+        if analysis.get("risk_flag") or crisis_result.get("is_crisis"):
+            yield await loop.run_in_executor(None, crisis_outputs)
+            return
 
-        # 4. Summary & Actions
-        summary_res = generate_with_fallback(SUMMARY_PROMPT.format(input_text=final_input, mood=mood))
-        summary_data = json.loads(summary_res.text.replace('```json', '').replace('```', ''))
-        
-        # 5. Journaling
-        journal_res = generate_with_fallback(JOURNALING_ANALYSIS_PROMPT.format(input_text=final_input, mood=mood))
-        journal_data = json.loads(journal_res.text.replace('```json', '').replace('```', ''))
-
-        # Save History
-        entry = {
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M"),
-            "input": final_input[:50] + "...",
-            "mood": mood,
-            "confidence": confidence,
-            "summary": summary_data.get("summary", "")
-        }
-        history = save_history(entry)
-        
         # Format Outputs
+        actions = analysis.get("actions", {})
         actions_html = f"""
         <div class='action-list'>
-            <div class='action-item'><b>🌬️ Breathe:</b> {summary_data['actions'].get('breathing')}</div>
-            <div class='action-item'><b>⚡ Do Now:</b> {summary_data['actions'].get('immediate')}</div>
-            <div class='action-item'><b>📅 Plan:</b> {summary_data['actions'].get('long_term')}</div>
+            <div class='action-item'><b>🌬️ Breathe:</b> {actions.get('breathing')}</div>
+            <div class='action-item'><b>⚡ Do Now:</b> {actions.get('immediate')}</div>
+            <div class='action-item'><b>📅 Plan:</b> {actions.get('long_term')}</div>
         </div>
         """
         
         journal_html = f"""
         <div class='journal-box'>
-            <p><b>Themes:</b> {', '.join(journal_data.get('themes', []))}</p>
+            <p><b>Themes:</b> {', '.join(analysis.get('themes', []))}</p>
             <p><b>Reflect on this:</b></p>
             <ol>
-                <li>{journal_data.get('prompts', [''])[0]}</li>
-                <li>{journal_data.get('prompts', [''])[1] if len(journal_data.get('prompts', [])) > 1 else ''}</li>
+                <li>{analysis.get('prompts', [''])[0]}</li>
+                <li>{analysis.get('prompts', [''])[1] if len(analysis.get('prompts', [])) > 1 else ''}</li>
             </ol>
         </div>
         """
 
-        return (
-            f"{mood} ({confidence}%)", 
-            therapy_msg, 
-            actions_html, 
-            journal_html, 
-            plot_mood_trend(history), 
-            format_history_html(history),
-            gr.update(visible=False)
-        )
+        result = {
+            "mood": mood,
+            "confidence": confidence,
+            "summary": analysis.get("summary", ""),
+            "therapy": "",
+            "actions_html": actions_html,
+            "journal_html": journal_html
+        }
+        yield await loop.run_in_executor(None, render_result, final_input, result)
+
+        # 2. Therapy Response - streamed into the coach box as it is generated,
+        # other outputs are left untouched
+        therapy_prompt = THERAPY_RESPONSE_PROMPT.format(input_text=final_input, mood=mood)
+        therapy_msg = ""
+        try:
+            async for chunk in stream_async(therapy_prompt):
+                therapy_msg += chunk
+                yield gr.update(), therapy_msg, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
+        except Exception as e:
+            # The analysis is already on screen and saved; only the coach box reports the failure
+            yield gr.update(), f"{therapy_msg}\n\n⚠️ Error: {str(e)}".strip(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
+            return
+
+        result["therapy"] = therapy_msg
+        exact_save(key, result)
+        await loop.run_in_executor(None, semantic_save, emb, result)
 
     except Exception as e:
-        return f"Error: {str(e)}", "", "", "", None, "", gr.update(visible=False)
+        yield f"Error: {str(e)}", "", "", "", None, "", gr.update(visible=False)
+
+def write_session_file(filename, content):
+    with open(filename, "w") as f:
+        f.write(content)
 
 def export_session(mood, therapy, actions):
     filename = f"session_{int(time.time())}.txt"
-    with open(filename, "w") as f:
-        f.write(f"EmotiCare Session\nMood: {mood}\n\nTherapy:\n{therapy}\n\nActions:\n{actions}")
+    content = f"EmotiCare Session\nMood: {mood}\n\nTherapy:\n{therapy}\n\nActions:\n{actions}"
+    future = disk_executor.submit(write_session_file, filename, content)
+    future.add_done_callback(log_write_error)
+    # The File component serves the path right away, so make sure it exists
+    try:
+        future.result(timeout=2)
+    except FutureTimeoutError:
+        gr.Warning("Export is taking longer than expected. Please try again in a moment.")
+        return None
+    except OSError as e:
+        gr.Warning(f"Could not save the session: {str(e)}")
+        return None
     return filename
 
 # --- UI Styling & Theme ---